@@ -33,6 +33,8 @@ setup(
     extras_require={
         'postgres': ["psycopg2>=2.6.2"],
         'mysql': ["PyMySQL>=0.7.10"],
+        # Faster decompression of accession2taxid files
+        'isal': ["isal"],
     },
 
     entry_points={
@@ -5,9 +5,12 @@ import os
 import sys
 import logging
 import argparse
+import threading
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
-from peewee import PeeweeException, OperationalError
+from peewee import PeeweeException, OperationalError, IntegrityError, \
+    MySQLDatabase
 
 from taxadb import util
 from taxadb import download
@@ -20,7 +23,9 @@ def download_files(args):
     """Main function for the `taxadb download` sub-command.
 
     This function can download taxump.tar.gz and the content of the
-    accession2taxid directory from the ncbi ftp.
+    accession2taxid directory from the ncbi ftp. Files are downloaded in
+    parallel (`args.workers` at a time), large files are themselves split in
+    `args.parts` ranges downloaded in parallel.
 
     Arguments:
              args (object): The arguments from argparse
@@ -40,32 +45,62 @@ def download_files(args):
     acc_dl_list = [taxdump]
 
     for div in args.type:
-        if div in ['full', 'nucl', 'gb']:
+        if div in ['full', 'nucl', 'gb'] and nucl_gb not in acc_dl_list:
             acc_dl_list.append(nucl_gb)
-        if div in ['full', 'nucl', 'wgs']:
+        if div in ['full', 'nucl', 'wgs'] and nucl_wgs not in acc_dl_list:
             acc_dl_list.append(nucl_wgs)
-        if div in ['full', 'prot']:
+        if div in ['full', 'prot'] and prot not in acc_dl_list:
             acc_dl_list.append(prot)
 
+    out = os.path.abspath(args.outdir)
     try:
-        out = args.outdir
-        os.makedirs(os.path.abspath(out), exist_ok=args.force)
-        os.chdir(os.path.abspath(out))
+        os.makedirs(out, exist_ok=args.force)
     except FileExistsError as e:
         logger.error('%s exists. Consider using -f if you want to overwrite'
-                     % out)
+                     % args.outdir)
         sys.exit(1)
 
-    for file in acc_dl_list:
+    def fetch(file):
+        path = 'pub/taxonomy/'
         if file != taxdump:
-            download.ncbi('pub/taxonomy/accession2taxid/', file)
-            download.ncbi('pub/taxonomy/accession2taxid/', file + '.md5')
-            util.md5_check(file)
-        else:
-            download.ncbi('pub/taxonomy/', taxdump)
-            download.ncbi('pub/taxonomy/', taxdump + '.md5')
-            util.md5_check(taxdump)
-            download.unpack(taxdump)
+            path += 'accession2taxid/'
+        download.ncbi(path, file, outdir=out, parts=args.parts, cancel=stop)
+        download.ncbi(path, file + '.md5', outdir=out, cancel=stop)
+
+    def check(file):
+        # Checks already queued are skipped once one has failed
+        if stop.is_set():
+            return
+        try:
+            util.md5_check(os.path.join(out, file))
+        except BaseException:
+            stop.set()
+            raise
+
+    # Downloads are network bound, fetch several files at once. md5 checks
+    # are CPU bound, each one runs as soon as its file is downloaded, while
+    # the remaining downloads go on. The first failure, download or md5
+    # check, stops everything: queued downloads and md5 checks are cancelled
+    # and running downloads are told to stop before the pools are shut down.
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, \
+            ThreadPoolExecutor(max_workers=2) as checker:
+        downloads = {pool.submit(fetch, file): file for file in acc_dl_list}
+        pending = set(downloads)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    if future in downloads:
+                        pending.add(checker.submit(check, downloads[future]))
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            stop.set()
+            raise
+    download.unpack(os.path.join(out, taxdump), outdir=out,
+                    members=['nodes.dmp', 'names.dmp'])
 
 
 def create_db(args):
@@ -82,10 +117,13 @@ def create_db(args):
         args.division (:obj:`str`): division to create the db for.
         args.fast (:obj:`bool`): Disables checks for faster db creation. Use
                                  with caution!
+        args.workers (:obj:`int`): Number of accession2taxid files to parse
+                                   in parallel.
 
     """
     logger = logging.getLogger(__name__)
-    database = DatabaseFactory(**args.__dict__).get_database()
+    factory = DatabaseFactory(**args.__dict__)
+    database = factory.get_database()
     div = args.division  # am lazy at typing
     db.initialize(database)
 
@@ -95,9 +133,13 @@ def create_db(args):
     acc_dl_list = []
 
     db.connect()
+    # Trading durability for speed is only safe while creating the database,
+    # a crash during an update would corrupt existing data
+    if not Taxa.table_exists():
+        factory.set_bulk_pragmas(database)
     parser = TaxaDumpParser(nodes_file=os.path.join(args.input, 'nodes.dmp'),
                             names_file=os.path.join(args.input, 'names.dmp'),
-                            verbose=args.verbose)
+                            chunk=args.chunk, verbose=args.verbose)
 
     logger.debug('Connected to database')
     # If taxa table already exists, do not recreate and fill it
@@ -106,26 +148,33 @@ def create_db(args):
         logger.info('Creating table %s' % str(Taxa.get_table_name()))
         db.create_tables([Taxa])
 
-    logger.info("Parsing files")
-    taxa_info_list = parser.taxdump()
-
     logger.info("Inserting taxonomy data")
-    total_size = len(taxa_info_list)
     try:
         with db.atomic():
-            for i in tqdm(range(0, total_size, args.chunk),
-                          unit=' chunks', desc='INFO:taxadb.app',
-                          total=''):
-                Taxa.insert_many(taxa_info_list[i:i+args.chunk]).execute()
+            for entries in tqdm(parser.taxdump(),
+                                unit=' chunks', desc='INFO:taxadb.app',
+                                total=''):
+                Taxa.bulk_insert(entries, [Taxa.ncbi_taxid,
+                                           Taxa.parent_taxid,
+                                           Taxa.tax_name,
+                                           Taxa.lineage_level])
     except OperationalError as e:
         print("\n")  # needed because the above counter has none
         logger.error("sqlite3 error: %s" % e)
-        logger.error("Maybe retry with a lower chunk size.")
         sys.exit(1)
     logger.info('Table Taxa completed')
 
-    # At first load, table accession does not exist yet, we create it
-    db.create_tables([Accession])
+    # At first load, table accession does not exist yet, we create it.
+    # The taxid index is only built once all accessions are loaded: one bulk
+    # build is much cheaper than updating it on every insert. The unique
+    # accession index is kept, it is used to check for existing accessions
+    # and makes a duplicate accession stop the load right away. MySQL needs
+    # an index on foreign keys, it is kept there.
+    if not Accession.table_exists():
+        logger.info('Creating table %s' % str(Accession.get_table_name()))
+        db.create_tables([Accession])
+        if not isinstance(database, MySQLDatabase):
+            db.execute_sql('DROP INDEX IF EXISTS accession_taxid_id')
 
     if div in ['full', 'nucl', 'gb']:
         acc_dl_list.append(nucl_gb)
@@ -133,32 +182,41 @@ def create_db(args):
         acc_dl_list.append(nucl_wgs)
     if div in ['full', 'prot']:
         acc_dl_list.append(prot)
-    parser = Accession2TaxidParser(verbose=args.verbose, fast=args.fast)
-    with db.atomic():
-        for acc_file in acc_dl_list:
-            inserted_rows = 0
-            logger.info("Parsing %s" % str(acc_file))
-            for data_dict in tqdm(
-                parser.accession2taxid(
-                    acc2taxid=os.path.join(args.input, acc_file),
+    parser = Accession2TaxidParser(verbose=args.verbose, fast=args.fast,
+                                   workers=args.workers)
+    inserted_rows = {acc_file: 0 for acc_file in acc_dl_list}
+    logger.info("Parsing %s" % ', '.join(acc_dl_list))
+    try:
+        with db.atomic():
+            for acc_file, entries in tqdm(
+                parser.accession2taxid_files(
+                    [os.path.join(args.input, acc_file)
+                     for acc_file in acc_dl_list],
                     chunk=args.chunk), unit=' chunks',
                     desc='INFO:taxadb.app',
                     total=''):
-                Accession.insert_many(data_dict[0:args.chunk]).execute()
-                inserted_rows += len(data_dict)
-            logger.info('%s: %s added to database (%d rows inserted)'
-                        % (Accession.get_table_name(),
-                            acc_file, inserted_rows))
-        if not Accession.has_index(name='accession_accession'):
-            logger.info('Creating index for %s'
-                        % Accession.get_table_name())
-            try:
-                # db.add_index(Accession, ['accession'], unique=True)
-                idx = db.index(db.Accession, name='accession', unique=True)
-                db.add_index(idx)
-            except PeeweeException as err:
-                raise Exception("Could not create Accession index: %s"
-                                % str(err))
+                acc_file = os.path.basename(acc_file)
+                inserted_rows[acc_file] += Accession.bulk_insert(
+                    entries, [Accession.accession, Accession.taxid])
+            for acc_file in acc_dl_list:
+                logger.info('%s: %s added to database (%d rows inserted)'
+                            % (Accession.get_table_name(),
+                                acc_file, inserted_rows[acc_file]))
+            if not Accession.has_index(name='accession_taxid_id'):
+                logger.info('Creating indexes for %s'
+                            % Accession.get_table_name())
+                try:
+                    Accession._schema.create_indexes(safe=True)
+                except PeeweeException as err:
+                    raise Exception("Could not create Accession index: %s"
+                                    % str(err))
+    except IntegrityError as e:
+        print("\n")  # needed because the above counter has none
+        logger.error("Could not insert accessions, nothing was loaded from "
+                     "accession2taxid files: %s. An accession is probably "
+                     "already in the database, do not use --fast to skip "
+                     "existing accessions" % e)
+        sys.exit(1)
     logger.info('Table Accession completed')
     db.close()
 
@@ -224,6 +282,23 @@ def main():
         default=False,
         help='Force download if the output directory exists',
     )
+    parser_download.add_argument(
+        '--workers',
+        '-w',
+        metavar='<#workers>',
+        type=int,
+        help='Number of files to download in parallel (default: %(default)s)',
+        default=4
+    )
+    parser_download.add_argument(
+        '--parts',
+        '-p',
+        metavar='<#parts>',
+        type=int,
+        help='Number of parallel range requests for each large file \
+            (default: %(default)s)',
+        default=4
+    )
     parser_download.add_argument(
         '--outdir',
         '-o',
@@ -264,7 +339,18 @@ def main():
         metavar='<#chunk>',
         type=int,
         help='Number of sequences to insert in bulk (default: %(default)s)',
-        default=500
+        # Rows are bound one by one through executemany, so the chunk size
+        # is not limited by the maximum number of SQL variables per query
+        default=10000
+    )
+    parser_create.add_argument(
+        '--workers',
+        '-w',
+        metavar='<#workers>',
+        type=int,
+        help='Number of accession2taxid files to parse in parallel \
+            (default: %(default)s)',
+        default=3
     )
     parser_create.add_argument(
         '--input',
@@ -1,46 +1,154 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import shutil
 import logging
 import tarfile
 import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+# Size of the chunks written to disk while downloading
+CHUNK_SIZE = 1024 * 1024
+# Files smaller than this are always downloaded with a single request
+RANGE_MIN_SIZE = 64 * 1024 * 1024
 
-def ncbi(path, filename, base_url='https://ftp.ncbi.nlm.nih.gov/'):
+_local = threading.local()
+
+
+def session():
+    """Get the requests session of the current thread
+
+    A session keeps the connection to the ncbi server alive between
+        downloads. Sessions are not thread safe, each thread has its own.
+
+    Returns:
+        :obj:`requests.Session`
+    """
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def ncbi(path, filename, base_url='https://ftp.ncbi.nlm.nih.gov/', parts=1,
+         outdir='.', cancel=None):
     """Download a file from the NCBI ftp using https
 
+    Files larger than `RANGE_MIN_SIZE` can be downloaded as `parts` byte
+        ranges fetched in parallel, if the server supports range requests.
+
     Arguments:
         path (string): base path to the file
         filename (string): filename
         base_url (string): address to the ncbi ftp
+        parts (int): number of parallel range requests. Default 1
+        outdir (string): directory to download the file into. Default current
+            directory
+        cancel (:obj:`threading.Event`): when set, the download stops and the
+            file is left incomplete. Default None
     """
     logger = logging.getLogger(__name__)
 
+    if _cancelled(cancel):
+        return
     url = base_url + path + filename
-    request = requests.get(url, stream=True)
-
+    output = os.path.join(outdir, filename)
     logger.info('Downloading %s' % filename)
+    if parts > 1:
+        head = session().head(url)
+        total_size = int(head.headers.get('content-length', 0))
+        if total_size >= RANGE_MIN_SIZE and \
+                head.headers.get('accept-ranges') == 'bytes':
+            _download_ranges(url, output, total_size, parts, cancel)
+            return
+
+    request = session().get(url, stream=True)
     total_size = int(request.headers.get('content-length', 0))
-    chunk_size = 1024
-    written = 0
+    with open(output, 'wb') as f, \
+            tqdm(total=total_size, unit='B', unit_scale=True) as progress:
+        for chunk in request.iter_content(chunk_size=CHUNK_SIZE):
+            if _cancelled(cancel):
+                break
+            if chunk:
+                f.write(chunk)
+                progress.update(len(chunk))
+
+
+def _cancelled(cancel):
+    """Check if a download has been asked to stop"""
+    return cancel is not None and cancel.is_set()
+
+
+def _download_ranges(url, filename, total_size, parts, cancel=None):
+    """Download a file as byte ranges fetched in parallel
+
+    The file is allocated first, then each thread writes its range at its
+        own offset through its own file object.
+
+    Arguments:
+        url (string): address of the file
+        filename (string): output file
+        total_size (int): size of the file, in bytes
+        parts (int): number of ranges
+        cancel (:obj:`threading.Event`): stops all ranges when set
+    """
     with open(filename, 'wb') as f:
-        for chunk in tqdm(request.iter_content(chunk_size=chunk_size),
-                          total=total_size/chunk_size,
-                          unit='Kb', unit_scale=True):
+        f.truncate(total_size)
+    step = -(-total_size // parts)
+    ranges = [(start, min(start + step, total_size) - 1)
+              for start in range(0, total_size, step)]
+    with tqdm(total=total_size, unit='B', unit_scale=True) as progress, \
+            ThreadPoolExecutor(max_workers=parts) as pool:
+        futures = [pool.submit(_download_range, url, filename, start, end,
+                               progress, cancel)
+                   for start, end in ranges]
+        for future in futures:
+            future.result()
+
+
+def _download_range(url, filename, start, end, progress, cancel=None):
+    """Download bytes `start` to `end` (included) of a file in place
+
+    Raises:
+        OSError: If the server did not answer with the requested range
+    """
+    request = session().get(url, stream=True,
+                            headers={'Range': 'bytes=%d-%d' % (start, end)})
+    if request.status_code != 206:
+        raise OSError('Range request on %s failed (HTTP %d)'
+                      % (url, request.status_code))
+    content_range = request.headers.get('content-range', '')
+    if not content_range.startswith('bytes %d-%d/' % (start, end)):
+        raise OSError('Range request on %s failed: asked bytes %d-%d, got %s'
+                      % (url, start, end, content_range or 'no range'))
+    with open(filename, 'r+b') as f:
+        f.seek(start)
+        for chunk in request.iter_content(chunk_size=CHUNK_SIZE):
+            if _cancelled(cancel):
+                break
             if chunk:
                 f.write(chunk)
-                f.flush()
+                progress.update(len(chunk))
 
 
-def unpack(filename):
+def unpack(filename, members=None, outdir='.'):
     """uncompress a tar.gz archive
+
+    The archive is read as a stream, decompressed and extracted in one pass.
+
+    Arguments:
+        filename (string): archive to uncompress
+        members (list): names of the files to extract. Default all
+        outdir (string): directory to extract the files into. Default current
+            directory
     """
     logger = logging.getLogger(__name__)
 
     logger.info('Unpacking %s' % filename)
-    with tarfile.open(filename, "r:gz") as archive:
-        archive.extractall()
-        archive.close()
+    with tarfile.open(filename, "r|gz") as archive:
+        for member in archive:
+            if members is None or member.name in members:
+                archive.extract(member, path=outdir)
@@ -1,13 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
+import re
 import sys
-import gzip
+import mmap
 import logging
+import multiprocessing
 
+from queue import Empty
+from taxadb.util import batched
 from taxadb.schema import Taxa, Accession
 
+try:
+    # python-isal decompresses noticeably faster than zlib, use it if present
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+# Seconds to wait for parsed chunks before checking worker processes are alive
+WORKER_POLL_TIMEOUT = 1
+# taxid, parent taxid and rank from a nodes.dmp line
+NODES_RE = re.compile(rb'(\d+)\t\|\t(\d+)\t\|\t([^\t]*)\t\|')
+# taxid and name from a names.dmp line, for scientific names only
+NAMES_RE = re.compile(
+    rb'(\d+)\t\|\t([^\t]*)\t\|\t[^\t]*\t\|\tscientific name\t\|')
+
 
 class TaxaParser(object):
 
@@ -27,12 +46,13 @@ class TaxaParser(object):
         """Load data from taxa table into a dictionary
 
         Returns:
-            data (:obj:`dict`): Data from taxa table mapped as dictionary
+            data (:obj:`dict`): Taxids (:obj:`int`) from taxa table mapped as
+                dictionary
 
         """
         data = {}
         for x in Taxa.select(Taxa.ncbi_taxid).dicts():
-            data[str(x['ncbi_taxid'])] = True
+            data[int(x['ncbi_taxid'])] = True
         return data
 
     @staticmethod
@@ -74,80 +94,67 @@ class TaxaDumpParser(TaxaParser):
     Args:
         nodes_file (:obj:`str`): Path to nodes.dmp file
         names_file (:obj:`str`): Path to names.dmp file
+        chunk (:obj:`int`): Chunk insert size. Default 500
 
     """
-    def __init__(self, nodes_file=None, names_file=None, **kwargs):
+    def __init__(self, nodes_file=None, names_file=None, chunk=500,
+                 **kwargs):
         """
 
         """
         super().__init__(**kwargs)
         self.nodes_file = nodes_file
         self.names_file = names_file
+        self.chunk = chunk
 
-    def taxdump(self, nodes_file=None, names_file=None):
+    def taxdump(self, nodes_file=None, names_file=None, chunk=None):
         """Parse .dmp files
 
-        Parse nodes.dmp and names.dmp files (from taxdump.tgz) and insert
-            taxons in Taxa table.
+        Parse nodes.dmp and names.dmp files (from taxdump.tgz), build a tuple
+            for each taxon with its scientific name and yield them by chunks
+            for insertion in Taxa table. Taxa already in the table are
+            skipped.
+
+        ::
+
+            (ncbi_taxid, parent_taxid, tax_name, lineage_level)
 
         Args:
             nodes_file (:obj:`str`): Path to nodes.dmp file
             names_file (:obj:`str`): Path to names.dmp file
+            chunk (:obj:`int`): Chunk size of entries to gather before
+                yielding. Default 500 (set at object construction)
 
-        Returns:
-            list: Zipped data from both files
+        Yields:
+            list: Chunk size of merged data from both files
 
         """
         if nodes_file is None:
             nodes_file = self.nodes_file
         if names_file is None:
             names_file = self.names_file
+        if chunk is None:
+            chunk = self.chunk
         self.check_file(names_file)
         self.check_file(nodes_file)
-        # parse nodes.dmp
-        nodes_data = list()
         self.logger.debug("Loading taxa data ...")
         ncbi_ids = self.cache_taxids()
-        self.logger.debug("Parsing %s" % str(nodes_file))
-        with open(nodes_file, 'r') as f:
-            for line in f:
-                line_list = line.split('|')
-                ncbi_id = line_list[0].strip('\t')
-                if ncbi_id in ncbi_ids:
-                    continue
-                data_dict = {
-                    'ncbi_taxid': ncbi_id,
-                    'parent_taxid': line_list[1].strip('\t'),
-                    'tax_name': '',
-                    'lineage_level': line_list[2].strip('\t')
-                }
-                nodes_data.append(data_dict)
-        self.logger.info('Parsed nodes.dmp')
-
-        # parse names.dmp
-        names_data = list()
-        self.logger.debug("Parsing %s" % str(names_file))
-        with open(names_file, 'r') as f:
-            for line in f:
-                if 'scientific name' in line:
-                    line_list = line.split('|')
-                    ncbi_id = line_list[0].strip('\t')
-                    if ncbi_id in ncbi_ids:
-                        continue
-                    data_dict = {
-                        'ncbi_taxid': line_list[0].strip('\t'),
-                        'tax_name': line_list[1].strip('\t')
-                    }
-                    names_data.append(data_dict)
-        self.logger.info('Parsed names.dmp')
-
-        # merge the two dictionaries
-        taxa_info_list = list()
-        for nodes, names in zip(nodes_data, names_data):
-            taxa_info = {**nodes, **names}  # PEP 448, requires python 3.5
-            taxa_info_list.append(taxa_info)
-        self.logger.debug('merge successful')
-        return taxa_info_list
+        self.logger.debug("Parsing %s and %s"
+                          % (str(nodes_file), str(names_file)))
+        # Scientific names are loaded first, so each node gets its own name
+        # whatever the order of both files
+        names = (NAMES_RE.match(line) for line in _mmap_lines(names_file)
+                 if b'scientific name' in line)
+        sci_names = dict(name.groups() for name in names if name)
+        nodes = (NODES_RE.match(line) for line in _mmap_lines(nodes_file))
+        rows = ((int(node.group(1)), int(node.group(2)),
+                 sci_names.get(node.group(1), b'').decode(),
+                 node.group(3).decode())
+                for node in nodes if node)
+        rows = (row for row in rows if row[0] not in ncbi_ids)
+        for entries in batched(rows, chunk):
+            yield entries
+        self.logger.info('Parsed nodes.dmp and names.dmp')
 
     def set_nodes_file(self, nodes_file):
         """Set nodes_file
@@ -205,26 +212,28 @@ class Accession2TaxidParser(TaxaParser):
         chunk (:obj:`int`): Chunk insert size. Default 500
         fast (:obj:`bool`): Directly load accession into database, do not check
                             existence.
+        workers (:obj:`int`): Number of files to decompress and parse in
+                              parallel. Default 1
     """
 
-    def __init__(self, acc_file=None, chunk=500, fast=False, **kwargs):
+    def __init__(self, acc_file=None, chunk=500, fast=False, workers=1,
+                 **kwargs):
         super().__init__(**kwargs)
         self.acc_file = acc_file
         self.chunk = chunk
         self.fast = fast
+        self.workers = workers
 
     def accession2taxid(self, acc2taxid=None, chunk=None):
         """Parses the accession2taxid files
 
-        This method parses the accession2taxid file, build a dictionary,
-            stores it in a list and yield for insertion in the database.
+        This method parses the accession2taxid file, build a tuple for each
+            entry, stores it in a list and yield for insertion in the
+            database.
 
         ::
 
-            {
-                'accession': accession_id_from_file,
-                'taxid': associated_taxonomic_id
-            }
+            (accession_id_from_file, associated_taxonomic_id)
 
 
         Args:
@@ -236,52 +245,128 @@ class Accession2TaxidParser(TaxaParser):
             list: Chunk size of read entries
 
         """
-        # Some accessions (e.g.: AAA22826) have a taxid = 0
-        entries = []
-        counter = 0
-        taxids = self.cache_taxids()
-        if not self.fast:
-            accessions = {}
         if acc2taxid is None:
             acc2taxid = self.acc_file
-        self.check_file(acc2taxid)
+        for acc_file, entries in self.accession2taxid_files([acc2taxid],
+                                                            chunk=chunk,
+                                                            workers=1):
+            yield entries
+
+    def accession2taxid_files(self, acc_files, chunk=None, workers=None,
+                              context=None):
+        """Parses several accession2taxid files in parallel
+
+        Each file is decompressed and parsed in its own process, at most
+            `workers` at a time. Parsed chunks are sent back through a bounded
+            queue so memory stays constant whatever the size of the files.
+            Checks against the database (see `fast`) are done in the calling
+            process.
+
+        Args:
+            acc_files (:obj:`list`): Paths to acc2taxid input files (gzipped)
+            chunk (:obj:`int`): Chunk size of entries to gather before
+                yielding. Default 500 (set at object construction)
+            workers (:obj:`int`): Number of files to parse in parallel.
+                Default 1 (set at object construction)
+            context (:obj:`multiprocessing.context.BaseContext`): Context used
+                to start the workers. Default the current start method
+
+        Yields:
+            tuple: The file the chunk comes from and a list of entries as
+                returned by `accession2taxid`
+
+        Raises:
+            SystemExit: If a file could not be parsed
+
+        """
+        for acc_file in acc_files:
+            self.check_file(acc_file)
         if chunk is None:
             chunk = self.chunk
-        self.logger.debug("Parsing %s" % str(acc2taxid))
-        self.logger.debug("Fast mode %s" % "ON" if self.fast else "OFF")
-        with gzip.open(acc2taxid, 'rb') as f:
-            f.readline()  # discard the header
-            for line in f:
-                line_list = line.decode().rstrip('\n').split('\t')
-                # Check the taxid already exists and get its id
-                if line_list[2] not in taxids:
+        if workers is None:
+            workers = self.workers
+        # Some accessions (e.g.: AAA22826) have a taxid = 0
+        taxids = self.cache_taxids()
+        self.logger.debug("Fast mode %s" % ("ON" if self.fast else "OFF"))
+        if workers <= 1:
+            for acc_file in acc_files:
+                self.logger.debug("Parsing %s" % str(acc_file))
+                for entries in _read_accession2taxid(acc_file, taxids, chunk):
+                    yield acc_file, self._check_accessions(entries)
+            return
+
+        if context is None:
+            context = multiprocessing.get_context()
+        queue = context.Queue(maxsize=4 * workers)
+        pending = list(range(len(acc_files)))
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    idx = pending.pop(0)
+                    self.logger.debug("Parsing %s" % str(acc_files[idx]))
+                    proc = context.Process(
+                        target=_accession2taxid_worker,
+                        args=(idx, acc_files[idx], taxids, chunk, queue))
+                    proc.start()
+                    running[idx] = proc
+                try:
+                    idx, entries = queue.get(timeout=WORKER_POLL_TIMEOUT)
+                except Empty:
+                    # A worker killed or crashed (OOM killer, segfault...)
+                    # never sends its final message, check none has died.
+                    # Workers exiting normally have already sent it.
+                    for idx, proc in list(running.items()):
+                        if proc.exitcode is not None and proc.exitcode != 0:
+                            running.pop(idx).join()
+                            self.logger.error(
+                                "Could not parse %s: worker exited with code"
+                                " %d" % (str(acc_files[idx]), proc.exitcode))
+                            sys.exit(1)
                     continue
-                # In case of an update or parsing an already inserted list of
-                # accessions
-                if not self.fast:
-                    if line_list[0] in accessions:
-                        continue
-                    try:
-                        Accession.get(Accession.accession == line_list[0])
-                    except Accession.DoesNotExist:
-                        accessions[line_list[0]] = True
-                    data_dict = {
-                        'accession': line_list[0],
-                        'taxid': line_list[2]
-                    }
+                if entries is None:
+                    running.pop(idx).join()
+                    self.logger.debug("Parsed %s" % str(acc_files[idx]))
+                elif isinstance(entries, Exception):
+                    running.pop(idx).join()
+                    self.logger.error("Could not parse %s: %s"
+                                      % (str(acc_files[idx]), str(entries)))
+                    sys.exit(1)
                 else:
-                    data_dict = {
-                        'accession': line_list[0],
-                        'taxid': line_list[2]
-                    }
-                entries.append(data_dict)
-                counter += 1
-                if counter == chunk:
-                    yield(entries)
-                    entries = []
-                    counter = 0
-        if len(entries):
-            yield(entries)
+                    yield acc_files[idx], self._check_accessions(entries)
+        finally:
+            for proc in running.values():
+                proc.terminate()
+                proc.join()
+
+    def _check_accessions(self, entries):
+        """Remove accessions duplicated in the chunk or already in the database
+
+        Does nothing in fast mode. Chunks are inserted before the next one is
+            parsed, so accessions of previous chunks are found in the database.
+
+        Args:
+            entries (:obj:`list`): Entries as returned by `accession2taxid`
+
+        Returns:
+            list: Entries to insert
+
+        """
+        if self.fast:
+            return entries
+        # In case of an update or parsing an already inserted list of
+        # accessions
+        checked = []
+        accessions = set()
+        for entry in entries:
+            if entry[0] in accessions:
+                continue
+            accessions.add(entry[0])
+            try:
+                Accession.get(Accession.accession == entry[0])
+            except Accession.DoesNotExist:
+                checked.append(entry)
+        return checked
 
     def set_accession_file(self, acc_file):
         """Set the accession file to use
@@ -301,3 +386,73 @@ class Accession2TaxidParser(TaxaParser):
         self.check_file(acc_file)
         self.acc_file = acc_file
         return True
+
+
+def _mmap_lines(path):
+    """Iterate over the lines of a file through a memory map
+
+    This avoids the text decoding and buffering layers of regular file
+        objects, lines are returned as bytes.
+
+    Args:
+        path (:obj:`str`): Path to the file
+
+    Yields:
+        bytes: Lines of the file, including the trailing newline
+
+    """
+    with open(path, 'rb') as f:
+        # Empty files can not be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b''):
+                yield line
+
+
+def _read_accession2taxid(acc2taxid, taxids, chunk):
+    """Read an accession2taxid file by chunks
+
+    Entries with a taxid not found in `taxids` are skipped. This does not
+        access the database so it can run in a separate process.
+
+    Args:
+        acc2taxid (:obj:`str`): Path to acc2taxid input file (gzipped)
+        taxids (:obj:`dict`): Taxids from Taxa table (see `cache_taxids`)
+        chunk (:obj:`int`): Chunk size of entries to gather before yielding
+
+    Yields:
+        list: Chunk size of (accession, taxid) tuples
+
+    """
+    # GzipFile reads small blocks by default, so wrap it in a larger
+    # buffer to cut down the number of decompression calls
+    with io.BufferedReader(gzip.open(acc2taxid, 'rb'),
+                           buffer_size=128 * 1024) as f:
+        f.readline()  # discard the header
+        # Columns are accession, accession.version, taxid and gi. Work on
+        # bytes and only decode the two columns we keep.
+        lines = (line.split(b'\t', 3) for line in f)
+        rows = ((line_list[0].decode('ascii'), int(line_list[2]))
+                for line_list in lines)
+        # Check the taxid already exists
+        rows = (row for row in rows if row[1] in taxids)
+        for entries in batched(rows, chunk):
+            yield entries
+
+
+def _accession2taxid_worker(idx, acc2taxid, taxids, chunk, queue):
+    """Process target sending parsed chunks of `acc2taxid` to `queue`
+
+    Chunks are sent along with `idx` to identify the file they come from. A
+        final `None` is sent once the file is fully parsed, or the exception
+        raised if parsing failed.
+
+    """
+    try:
+        for entries in _read_accession2taxid(acc2taxid, taxids, chunk):
+            queue.put((idx, entries))
+    except Exception as err:
+        queue.put((idx, err))
+    else:
+        queue.put((idx, None))
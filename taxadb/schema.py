@@ -49,6 +49,30 @@ class BaseModel(pw.Model):
             return cls._has_columns_index(columns)
         return False
 
+    @classmethod
+    def bulk_insert(cls, rows, fields):
+        """Insert rows using the database driver `executemany`
+
+        Peewee only builds the INSERT statement for a single row, rows are
+            then handed as is to the driver. This avoids building one huge
+            query with every value per chunk, which is much faster for bulk
+            loading.
+
+        Args:
+            rows (:obj:`list`): Rows to insert, as tuples of values
+            fields (:obj:`list`): Fields (:obj:`pw.Field`) matching the order
+                of the values in `rows`
+
+        Returns:
+            int: Number of rows inserted
+
+        """
+        sql, _ = cls.insert_many([[None] * len(fields)],
+                                 fields=fields).returning().sql()
+        with pw.__exception_wrapper__:
+            db.cursor().executemany(sql, rows)
+        return len(rows)
+
     @classmethod
     def _has_named_index(cls, name):
         indexes = db.get_indexes(cls.get_table_name())
@@ -130,6 +154,17 @@ class DatabaseFactory(object):
 
     SUPPORTED_DBS = ['sqlite', 'postgres', 'mysql']
     DEFAULT_SECTION = 'DBSETTINGS'
+    # SQLite settings used while building a new database, durability is
+    # traded for insert speed. A crash only loses a database that was being
+    # created, they must not be used when updating an existing one.
+    SQLITE_BULK_PRAGMAS = [
+        ('journal_mode', 'wal'),
+        ('synchronous', 0),
+        ('foreign_keys', 0),
+        ('temp_store', 'memory'),
+        ('cache_size', -1 * 262144),
+        ('mmap_size', 268435456),
+    ]
 
     def __init__(self, config=None, **kwargs):
 
@@ -185,6 +220,25 @@ class DatabaseFactory(object):
                     host=self.get('hostname'),
                     port=int(self.get('port')))
 
+    def set_bulk_pragmas(self, database):
+        """Tune an SQLite connection for bulk loading
+
+        Only meant for new databases (see `SQLITE_BULK_PRAGMAS`). Does nothing
+            for other database types.
+
+        Args:
+            database (:obj:`pw.Database`): Connected database, as returned by
+                `get_database`
+
+        Returns:
+            True
+
+        """
+        if isinstance(database, pw.SqliteDatabase):
+            for pragma, value in DatabaseFactory.SQLITE_BULK_PRAGMAS:
+                database.pragma(pragma, value)
+        return True
+
     def get(self, name, section=DEFAULT_SECTION):
         """Get a database connection setting
 
@@ -2,13 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import shutil
+import tarfile
+import argparse
+import time
+import tempfile
+import threading
+import multiprocessing
 import unittest
 
+from unittest import mock
+from taxadb.app import download_files, create_db
 from taxadb.taxid import TaxID
 from taxadb.names import SciName
 from taxadb.taxadb import TaxaDB
-from taxadb.util import md5_check
-from taxadb.schema import Accession, Taxa
+from taxadb.util import md5_check, batched, _read_blocks
+from taxadb.download import ncbi, unpack, _download_range
+from taxadb.schema import Accession, Taxa, DatabaseFactory
 from taxadb.accessionid import AccessionID
 from taxadb.parser import TaxaParser, TaxaDumpParser, Accession2TaxidParser
 
@@ -16,6 +27,50 @@ from testconfig import config
 from nose.plugins.attrib import attr
 
 
+def _crashed_worker(*args):
+    """Worker process dying without sending anything back"""
+    os._exit(9)
+
+
+class _FakeResponse(object):
+    """Streamed reply of `_FakeSession`"""
+
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+
+class _FakeSession(object):
+    """Session serving `data`, honouring range requests if `ranges`"""
+
+    def __init__(self, data, ranges=True):
+        self.data = data
+        self.ranges = ranges
+        self.requested = []
+
+    def head(self, url):
+        headers = {'content-length': str(len(self.data))}
+        if self.ranges:
+            headers['accept-ranges'] = 'bytes'
+        return _FakeResponse(b'', headers=headers)
+
+    def get(self, url, stream=False, headers=None):
+        requested = (headers or {}).get('Range')
+        self.requested.append(requested)
+        if requested is None or not self.ranges:
+            return _FakeResponse(self.data, headers={
+                'content-length': str(len(self.data))})
+        start, end = [int(x) for x in requested[6:].split('-')]
+        return _FakeResponse(self.data[start:end + 1], status_code=206,
+                             headers={'content-range': 'bytes %d-%d/%d'
+                                      % (start, end, len(self.data))})
+
+
 class TestMainFunc(unittest.TestCase):
     """Class to test global methods"""
 
@@ -53,6 +108,203 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(SystemExit):
             md5_check(badfile)
 
+    @attr('util')
+    def test_read_blocks(self):
+        """Check file is entirely read by blocks"""
+        okfile = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              'good.txt')
+        with open(okfile, 'rb') as f:
+            content = f.read()
+        # Buffers are reused, blocks must be copied before reading the next
+        blocks = [bytes(block) for block in _read_blocks(okfile, 2, depth=1)]
+        self.assertTrue(all(len(block) <= 2 for block in blocks))
+        self.assertEqual(b''.join(blocks), content)
+        with self.assertRaises(OSError):
+            list(_read_blocks('/fakefile', 2))
+
+    @attr('util')
+    def test_batched(self):
+        """Check iterable is split in lists of the requested size"""
+        batches = list(batched(iter(range(7)), 3))
+        self.assertListEqual(batches, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertListEqual(list(batched([], 3)), [])
+
+
+class TestDownload(unittest.TestCase):
+    """Class to test taxadb.download"""
+
+    @attr('download')
+    def test_unpack_members(self):
+        """Check only requested members are extracted from archive"""
+        testdir = os.path.dirname(os.path.realpath(__file__))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, 'taxdump.tar.gz')
+            with tarfile.open(archive, 'w:gz') as tar:
+                tar.add(os.path.join(testdir, 'test-nodes.dmp'),
+                        arcname='nodes.dmp')
+                tar.add(os.path.join(testdir, 'test-names.dmp'),
+                        arcname='names.dmp')
+                tar.add(os.path.join(testdir, 'good.txt'),
+                        arcname='other.dmp')
+            unpack(archive, members=['nodes.dmp', 'names.dmp'],
+                   outdir=tmpdir)
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir,
+                                                        'nodes.dmp')))
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir,
+                                                        'names.dmp')))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir,
+                                                         'other.dmp')))
+
+    def _ncbi(self, fake, tmpdir, parts=4):
+        """Download from `fake` session, return the downloaded content"""
+        with mock.patch('taxadb.download.session', lambda: fake), \
+                mock.patch('taxadb.download.RANGE_MIN_SIZE', 0), \
+                mock.patch('taxadb.download.CHUNK_SIZE', 7):
+            ncbi('pub/taxonomy/', 'taxdump.tar.gz', base_url='http://fake/',
+                 parts=parts, outdir=tmpdir)
+        with open(os.path.join(tmpdir, 'taxdump.tar.gz'), 'rb') as f:
+            return f.read()
+
+    @attr('download')
+    def test_ncbi_ranges(self):
+        """Check a file downloaded as several ranges is rebuilt as is"""
+        data = bytes(range(256)) * 4 + b'end'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fake = _FakeSession(data)
+            self.assertEqual(self._ncbi(fake, tmpdir), data)
+            self.assertEqual(len(fake.requested), 4)
+            self.assertNotIn(None, fake.requested)
+
+    @attr('download')
+    def test_ncbi_ranges_not_supported(self):
+        """Check the file is downloaded with a single request if the server
+        does not accept ranges"""
+        data = bytes(range(256)) * 4 + b'end'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fake = _FakeSession(data, ranges=False)
+            self.assertEqual(self._ncbi(fake, tmpdir), data)
+            self.assertListEqual(fake.requested, [None])
+
+    @attr('download')
+    def test_download_range_fails(self):
+        """Check method throws OSError when the reply is not the requested
+        range"""
+        data = bytes(range(256))
+        fake = _FakeSession(data)
+        with tempfile.NamedTemporaryFile() as f, \
+                mock.patch('taxadb.download.session', lambda: fake):
+            # Server ignoring the range, whole file sent with a 200
+            fake.ranges = False
+            with self.assertRaises(OSError):
+                _download_range('http://fake/', f.name, 0, 9, mock.Mock())
+            # Server sending another range than the requested one
+            fake.ranges = True
+            fake.get = lambda *args, **kwargs: _FakeResponse(
+                data[10:20], status_code=206,
+                headers={'content-range': 'bytes 10-19/256'})
+            with self.assertRaises(OSError):
+                _download_range('http://fake/', f.name, 0, 9, mock.Mock())
+
+    def _download_files_fails(self, ncbi, md5_check, workers):
+        """Run download_files with mocked downloads and md5 checks, check it
+        stops without unpacking taxdump"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args = argparse.Namespace(type=[['full']], force=False,
+                                      workers=workers, parts=1,
+                                      outdir=os.path.join(tmpdir, 'out'))
+            with mock.patch('taxadb.download.ncbi', ncbi), \
+                    mock.patch('taxadb.util.md5_check', md5_check), \
+                    mock.patch('taxadb.download.unpack') as unpack:
+                with self.assertRaises(SystemExit):
+                    download_files(args)
+            self.assertFalse(unpack.called)
+
+    @attr('download')
+    def test_download_files_md5_fails(self):
+        """Check a failed md5 check stops remaining downloads and md5 checks
+        right away"""
+        fetched = []
+
+        def ncbi(path, filename, cancel=None, **kwargs):
+            if cancel.is_set():
+                return
+            fetched.append(filename)
+            if not filename.startswith('taxdump.tar.gz'):
+                # Long download, only ends when asked to stop
+                self.assertTrue(cancel.wait(5))
+
+        def md5_check(filename):
+            if filename.endswith('taxdump.tar.gz'):
+                sys.exit(1)
+
+        self._download_files_fails(ncbi, md5_check, workers=1)
+        self.assertNotIn('nucl_wgs.accession2taxid.gz', fetched)
+        self.assertNotIn('prot.accession2taxid.gz', fetched)
+
+        # Downloads all end while taxdump is checked, 2 checks run at once
+        # so one accession2taxid check runs and the 2 others are queued
+        checking = threading.Event()
+        stop = []
+        checked = []
+
+        def ncbi(path, filename, cancel=None, **kwargs):
+            stop.append(cancel)
+            if not filename.startswith('taxdump.tar.gz'):
+                self.assertTrue(checking.wait(5))
+
+        def md5_check(filename):
+            checked.append(os.path.basename(filename))
+            if filename.endswith('taxdump.tar.gz'):
+                checking.set()
+                # Let the other checks be submitted
+                time.sleep(0.5)
+                sys.exit(1)
+            # Runs until taxdump check fails, queued checks are skipped
+            self.assertTrue(stop[0].wait(5))
+
+        self._download_files_fails(ncbi, md5_check, workers=4)
+        self.assertEqual(len(checked), 2)
+        self.assertEqual(checked[0], 'taxdump.tar.gz')
+
+
+class TestApp(unittest.TestCase):
+    """Class to test taxadb.app"""
+
+    @attr('app')
+    def test_create_db_update(self):
+        """Check loading accessions already in the database exits in fast
+        mode, keeping the database as it was, and skips them otherwise. Bulk
+        loading pragmas are only set on the new database"""
+        testdir = os.path.dirname(os.path.realpath(__file__))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for src, dst in [('test-nodes.dmp', 'nodes.dmp'),
+                             ('test-names.dmp', 'names.dmp'),
+                             ('test-acc2taxid.gz',
+                              'nucl_gb.accession2taxid.gz')]:
+                shutil.copy(os.path.join(testdir, src),
+                            os.path.join(tmpdir, dst))
+            dbname = os.path.join(tmpdir, 'taxadb.sqlite')
+            args = argparse.Namespace(input=tmpdir, dbname=dbname,
+                                      dbtype='sqlite', division='gb',
+                                      fast=True, chunk=500, workers=1,
+                                      verbose=False, hostname=None,
+                                      password=None, port=None,
+                                      username=None)
+            with mock.patch.object(
+                    DatabaseFactory, 'set_bulk_pragmas', autospec=True,
+                    side_effect=DatabaseFactory.set_bulk_pragmas) as pragmas:
+                create_db(args)
+                with self.assertRaises(SystemExit):
+                    create_db(args)
+                args.fast = False
+                create_db(args)
+            self.assertEqual(pragmas.call_count, 1)
+            db = TaxaDB(dbtype='sqlite', dbname=dbname)
+            self.assertEqual(Accession.select().count(), 55211)
+            self.assertTrue(Accession.has_index(name='accession_accession'))
+            self.assertTrue(Accession.has_index(name='accession_taxid_id'))
+            db.db.close()
+
 
 class TestTaxadb(unittest.TestCase):
     """Main class to test AccessionID and TaxID method with sqlite"""
@@ -176,6 +428,25 @@ class TestTaxadb(unittest.TestCase):
         self.assertTrue(FooBar.has_index(name='name'))
         FooBar.drop_table()
 
+    @attr('schema')
+    def test_bulk_insert(self):
+        """Check method inserts all rows with values in fields order"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = TaxaDB(dbtype='sqlite',
+                        dbname=os.path.join(tmpdir, 'empty_db.sqlite'))
+            db.db.create_tables([Taxa])
+            rows = [(1, 'root', 1, 'no rank'),
+                    (2, 'Bacteria', 1, 'superkingdom')]
+            inserted = Taxa.bulk_insert(rows, [Taxa.ncbi_taxid, Taxa.tax_name,
+                                               Taxa.parent_taxid,
+                                               Taxa.lineage_level])
+            self.assertEqual(inserted, 2)
+            taxon = Taxa.get(Taxa.ncbi_taxid == 2)
+            self.assertEqual(taxon.tax_name, 'Bacteria')
+            self.assertEqual(taxon.parent_taxid, 1)
+            self.assertEqual(taxon.lineage_level, 'superkingdom')
+            db.db.close()
+
     @attr('config')
     def test_setconfig_from_envvar(self):
         """Check using configuration from environment variable is ok"""
@@ -273,6 +544,20 @@ class TestTaxadb(unittest.TestCase):
         with self.assertRaises(SystemExit):
             db = AccessionID(dbname='/unaccessible', dbtype='sqlite')
 
+    @attr('getdb')
+    def test_set_bulk_pragmas(self):
+        """Check method sets bulk loading pragmas on SQLite databases"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            factory = DatabaseFactory(
+                dbtype='sqlite',
+                dbname=os.path.join(tmpdir, 'empty_db.sqlite'))
+            database = factory.get_database()
+            database.connect()
+            self.assertTrue(factory.set_bulk_pragmas(database))
+            self.assertEqual(database.pragma('synchronous'), 0)
+            self.assertEqual(database.pragma('temp_store'), 2)
+            database.close()
+
     @attr('accessionid')
     def test_accession_taxid(self):
         """Check the method get the correct taxid for a given accession id"""
@@ -478,6 +763,8 @@ class TestTaxadbParser(unittest.TestCase):
         self.testdb = os.path.join(self.testdir, 'empty_db.sqlite')
         self.db = os.path.join(self.testdir, 'test_db.sqlite')
         self.chunk = 500
+        self.taxa_fields = [Taxa.ncbi_taxid, Taxa.parent_taxid, Taxa.tax_name,
+                            Taxa.lineage_level]
 
     def tearDown(self):
         if os.path.exists(self.testdb):
@@ -509,8 +796,29 @@ class TestTaxadbParser(unittest.TestCase):
         db.db.create_tables([Taxa])
         dp = TaxaDumpParser(verbose=True, nodes_file=self.nodes,
                             names_file=self.names)
-        l = dp.taxdump()
-        self.assertEqual(len(l), 14)
+        total_entries = 0
+        for taxa in dp.taxdump(chunk=5):
+            self.assertLessEqual(len(taxa), 5)
+            total_entries += len(taxa)
+        self.assertEqual(total_entries, 14)
+
+    @attr('parser')
+    def test_taxadumpparser_taxdump_names_order(self):
+        """Check taxa get their own scientific name whatever the order of
+        names.dmp"""
+        db = TaxaDB(dbtype='sqlite', dbname=self.testdb)
+        db.db.create_tables([Taxa])
+        with open(self.names) as f:
+            lines = f.readlines()
+        with tempfile.NamedTemporaryFile('w', suffix='.dmp') as names:
+            names.writelines(reversed(lines))
+            names.flush()
+            dp = TaxaDumpParser(nodes_file=self.nodes, names_file=names.name)
+            taxa = dict((taxon[0], taxon[2]) for entries in dp.taxdump()
+                        for taxon in entries)
+        self.assertEqual(len(taxa), 14)
+        self.assertEqual(taxa[2], 'Bacteria')
+        self.assertEqual(taxa[5664], 'Leishmania major')
 
     @attr('parser')
     def test_taxadumpparser_setnodes_throws(self):
@@ -556,10 +864,9 @@ class TestTaxadbParser(unittest.TestCase):
         # We need to load names.dmp and nodes.dmp
         tp = TaxaDumpParser(nodes_file=self.nodes, names_file=self.names,
                             verbose=True)
-        taxa_info = tp.taxdump()
         with db.db.atomic():
-            for i in range(0, len(taxa_info), self.chunk):
-                Taxa.insert_many(taxa_info[i:i + self.chunk]).execute()
+            for taxa_info in tp.taxdump():
+                Taxa.insert_many(taxa_info, fields=self.taxa_fields).execute()
         ap = Accession2TaxidParser(acc_file=self.acc, chunk=self.chunk,
                                    verbose=True)
         acc_list = ap.accession2taxid()
@@ -568,6 +875,62 @@ class TestTaxadbParser(unittest.TestCase):
             total_entrires += len(accs)
         self.assertEqual(total_entrires, 55211)
 
+    @attr('parser')
+    def test_accessionparser_accession2taxid_files(self):
+        """Check method yields entries of all files when parsed in parallel,
+        skipping already seen accessions unless in fast mode"""
+        db = TaxaDB(dbtype='sqlite', dbname=self.testdb)
+        db.db.create_tables([Taxa])
+        db.db.create_tables([Accession])
+        tp = TaxaDumpParser(nodes_file=self.nodes, names_file=self.names)
+        with db.db.atomic():
+            for taxa_info in tp.taxdump():
+                Taxa.insert_many(taxa_info, fields=self.taxa_fields).execute()
+        fields = [Accession.accession, Accession.taxid]
+        for fast, expected in [(True, 2 * 55211), (False, 55211)]:
+            ap = Accession2TaxidParser(chunk=self.chunk, fast=fast,
+                                       workers=2)
+            total_entries = 0
+            for acc_file, accs in ap.accession2taxid_files([self.acc,
+                                                            self.acc]):
+                self.assertEqual(acc_file, self.acc)
+                total_entries += len(accs)
+                # Chunks are inserted as they come, as create_db does, so
+                # accessions of the second file are found in the database
+                if not fast:
+                    Accession.bulk_insert(accs, fields)
+            self.assertEqual(total_entries, expected)
+
+    @attr('parser')
+    def test_accessionparser_accession2taxid_files_spawn(self):
+        """Check method works when workers are started with spawn (default
+        on macOS and Windows)"""
+        db = TaxaDB(dbtype='sqlite', dbname=self.testdb)
+        db.db.create_tables([Taxa])
+        tp = TaxaDumpParser(nodes_file=self.nodes, names_file=self.names)
+        with db.db.atomic():
+            for taxa_info in tp.taxdump():
+                Taxa.insert_many(taxa_info, fields=self.taxa_fields).execute()
+        ap = Accession2TaxidParser(chunk=self.chunk, fast=True, workers=2)
+        total_entries = 0
+        for acc_file, accs in ap.accession2taxid_files(
+                [self.acc, self.acc],
+                context=multiprocessing.get_context('spawn')):
+            total_entries += len(accs)
+        self.assertEqual(total_entries, 2 * 55211)
+
+    @attr('parser')
+    def test_accessionparser_accession2taxid_files_crashed_worker(self):
+        """Check method throws SystemExit when a worker process dies without
+        reporting"""
+        db = TaxaDB(dbtype='sqlite', dbname=self.testdb)
+        db.db.create_tables([Taxa])
+        ap = Accession2TaxidParser(chunk=self.chunk, fast=True, workers=2)
+        with mock.patch('taxadb.parser._accession2taxid_worker',
+                        _crashed_worker):
+            with self.assertRaises(SystemExit):
+                list(ap.accession2taxid_files([self.acc, self.acc]))
+
     @attr('parser')
     def test_accessionparser_set_accession_file_throws(self):
         """Check method throws when file is None or does not exists"""
@@ -2,24 +2,34 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import queue
 import hashlib
 import logging
+import threading
 
+from itertools import islice
 
-def md5_check(file, block_size=256*128):
+
+def md5_check(file, block_size=1024*1024):
     """Check the md5 of files large or small
 
     Args:
         file (str): input file
-        block_size (int): block_size for the file chunks. Default = 256*128
+        block_size (int): block_size for the file chunks. Default = 1 MiB.
+            Not used with python >= 3.11
     """
     logger = logging.getLogger(__name__)
 
     logger.info('Checking md5 of %s' % file)
-    md5 = open(file + '.md5').readline().split()[0]
-    file_md5 = hashlib.md5()
-    with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(block_size), b''):
+    with open(file + '.md5') as f:
+        md5 = f.readline().split()[0]
+    if hasattr(hashlib, 'file_digest'):
+        # python >= 3.11, the file is read and hashed from C code
+        with open(file, 'rb') as f:
+            file_md5 = hashlib.file_digest(f, 'md5')
+    else:
+        file_md5 = hashlib.md5()
+        for chunk in _read_blocks(file, block_size):
             file_md5.update(chunk)
     try:
         assert(file_md5.hexdigest() == md5)
@@ -29,3 +39,70 @@ def md5_check(file, block_size=256*128):
         sys.exit(1)
     else:
         logger.info('Checking md5 of %s: OK' % file)
+
+
+def _read_blocks(file, block_size, depth=4):
+    """Read a file by blocks in a background thread
+
+    Up to `depth` blocks are read ahead, so reading overlaps with whatever
+        the caller does with the current block (hashing releases the GIL).
+        Blocks are read into a fixed set of reused buffers: a block is only
+        valid until the next one is requested.
+
+    Args:
+        file (str): input file
+        block_size (int): size of the blocks
+        depth (int): maximum number of blocks read ahead
+
+    Yields:
+        memoryview: consecutive blocks of `file`
+    """
+    free = queue.Queue()
+    for _ in range(depth + 1):
+        free.put(bytearray(block_size))
+    blocks = queue.Queue()
+
+    def reader():
+        try:
+            with open(file, 'rb') as f:
+                buf = free.get()
+                size = f.readinto(buf)
+                while size:
+                    blocks.put((buf, size))
+                    buf = free.get()
+                    size = f.readinto(buf)
+        except OSError as err:
+            blocks.put((err, 0))
+        else:
+            blocks.put((None, 0))
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    buf, size = blocks.get()
+    while buf is not None:
+        if isinstance(buf, OSError):
+            raise buf
+        yield memoryview(buf)[:size]
+        free.put(buf)
+        buf, size = blocks.get()
+    thread.join()
+
+
+def batched(iterable, size):
+    """Split an iterable into lists of `size` elements
+
+    Only the current list is held in memory, so this can be used to stream
+        arbitrarily large files by chunks.
+
+    Args:
+        iterable (iterable): elements to split
+        size (int): number of elements per list. The last one may be shorter
+
+    Yields:
+        list: `size` consecutive elements of `iterable`
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))